@@ -5,9 +5,7 @@ import logging
 import os
 import re
 import time
-from collections import defaultdict
 from datetime import UTC, datetime, timedelta
-from itertools import islice
 
 import requests
 import requests.exceptions as requests_exceptions
@@ -15,6 +13,9 @@ from google.api_core import exceptions as api_exceptions
 from google.api_core import retry_async
 from google.auth import exceptions as auth_exceptions
 from google.cloud import artifactregistry_v1
+from google.cloud.artifactregistry_v1.services.artifact_registry.transports import (
+    ArtifactRegistryGrpcAsyncIOTransport,
+)
 
 logging.basicConfig(
     format="%(asctime)s - %(funcName)s - %(message)s",
@@ -49,15 +50,66 @@ def should_retry(exc):
         return False
 
 
-ASYNC_RETRY = retry_async.AsyncRetry(predicate=should_retry)
+# Truncated exponential back-off. AsyncRetry sleeps for a random amount of
+# time below the current delay, so concurrent requests that get rate limited
+# together don't retry in lockstep.
+RETRY_INITIAL_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRY_MULTIPLIER = 2.0
+RETRY_TIMEOUT = 300.0
 
 
-async def batch_delete_versions(targets, args):
-    client = artifactregistry_v1.ArtifactRegistryAsyncClient()
-    start = time.time()
-    for package in targets:
-        batches = batched(targets[package], 50)
-        for batch in batches:
+def make_retry(args):
+    """Build the retry policy shared by every request of a run."""
+    return retry_async.AsyncRetry(
+        predicate=should_retry,
+        initial=RETRY_INITIAL_DELAY,
+        maximum=args.retry_max_delay,
+        multiplier=RETRY_MULTIPLIER,
+        timeout=args.retry_timeout,
+    )
+
+
+# Options of the gRPC channel used by the shared client. Message sizes are
+# unbounded like on the client's default channel, and keepalive pings stop
+# the connection from going stale during long scans.
+GRPC_CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+_CLIENT = None
+
+
+def get_client():
+    """Return the Artifact Registry client shared by all requests."""
+    global _CLIENT
+    if _CLIENT is None:
+        # Passing our own channel bypasses the client's endpoint selection, so
+        # GOOGLE_API_USE_MTLS_ENDPOINT and client certificates are not honored
+        # and requests always go to the regular endpoint.
+        channel = ArtifactRegistryGrpcAsyncIOTransport.create_channel(
+            f"{ArtifactRegistryGrpcAsyncIOTransport.DEFAULT_HOST}:443",
+            options=GRPC_CHANNEL_OPTIONS,
+        )
+        _CLIENT = artifactregistry_v1.ArtifactRegistryAsyncClient(
+            transport=ArtifactRegistryGrpcAsyncIOTransport(channel=channel),
+        )
+    return _CLIENT
+
+
+# Maximum number of packages whose versions are listed concurrently.
+LIST_CONCURRENCY = 50
+
+
+async def batch_delete_versions(targets, args, retry):
+    client = get_client()
+    semaphore = asyncio.Semaphore(args.delete_concurrency)
+
+    async def delete(package, batch):
+        async with semaphore:
             logging.info(
                 f"{'Would delete' if args.dry_run else 'Deleting'} {format(len(batch), ',')} expired package versions of {os.path.basename(package)}..."
             )
@@ -66,10 +118,17 @@ async def batch_delete_versions(targets, args):
                 names=batch,
                 validate_only=args.dry_run,
             )
-            operation = await client.batch_delete_versions(
-                request=request, retry=ASYNC_RETRY
-            )
+            operation = await client.batch_delete_versions(request=request, retry=retry)
             await operation.result()
+
+    start = time.time()
+    await asyncio.gather(
+        *(
+            delete(package, batch)
+            for package in targets
+            for batch in batched_seq(targets[package], 50)
+        )
+    )
     end = time.time()
     elapsed = int(end - start)
     logging.info(
@@ -77,75 +136,210 @@ async def batch_delete_versions(targets, args):
     )
 
 
-async def get_repository(args):
-    client = artifactregistry_v1.ArtifactRegistryAsyncClient()
+async def get_repository(args, retry):
+    client = get_client()
     parent = f"projects/{os.environ['GOOGLE_CLOUD_PROJECT']}/locations/{args.region}/repositories/{args.repository}"
     get_repository_request = artifactregistry_v1.GetRepositoryRequest(
         name=parent,
     )
     repository = await client.get_repository(
-        request=get_repository_request, retry=ASYNC_RETRY
+        request=get_repository_request, retry=retry
     )
     return repository
 
 
-def batched(iterable, n):
-    "Batch data into tuples of length n. The last batch may be shorter."
-    # batched('ABCDEFG', 3) --> ABC DEF G
+def batched_seq(sequence, n):
+    "Batch a sequence into slices of length n. The last batch may be shorter."
+    # batched_seq('ABCDEFG', 3) --> ABC DEF G
     if n < 1:
         raise ValueError("n must be at least one")
-    it = iter(iterable)
-    batch = tuple(islice(it, n))
-    while batch:
-        yield batch
-        batch = tuple(islice(it, n))
+    for i in range(0, len(sequence), n):
+        yield sequence[i : i + n]
 
 
-async def list_packages(repository):
-    client = artifactregistry_v1.ArtifactRegistryAsyncClient()
+async def list_packages(repository, retry):
+    client = get_client()
     request = artifactregistry_v1.ListPackagesRequest(
         parent=repository.name,
         page_size=1000,
     )
-    packages = await client.list_packages(request=request, retry=ASYNC_RETRY)
+    packages = await client.list_packages(request=request, retry=retry)
     return packages
 
 
-async def list_versions(package):
-    client = artifactregistry_v1.ArtifactRegistryAsyncClient()
+async def list_versions(package, retry):
+    client = get_client()
     request = artifactregistry_v1.ListVersionsRequest(
         parent=package.name,
         page_size=1000,
+        # Oldest first, so that listing can stop at the first unexpired version.
+        order_by="create_time",
+        # Only the name and create time of versions are used, don't fetch tags.
+        view=artifactregistry_v1.VersionView.BASIC,
     )
-    versions = await client.list_versions(request=request, retry=ASYNC_RETRY)
+    versions = await client.list_versions(request=request, retry=retry)
     return versions
 
 
+def get_cache_path():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "mozilla-linux-pkg-manager", "state.json")
+
+
+def load_cache():
+    """Load the create time of the oldest remaining version of each package."""
+    path = get_cache_path()
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable cache file {path}: {e}")
+        return {}
+    if not isinstance(cache, dict):
+        logging.warning(f"Ignoring cache file {path}: not a JSON object")
+        return {}
+    valid_cache = {}
+    for package_name, create_time in cache.items():
+        try:
+            if datetime.fromisoformat(create_time).tzinfo is None:
+                raise ValueError("missing UTC offset")
+        except (TypeError, ValueError) as e:
+            logging.warning(
+                f"Ignoring invalid cache entry {package_name} = {create_time!r}: {e}"
+            )
+            continue
+        valid_cache[package_name] = create_time
+    return valid_cache
+
+
+def save_cache(cache):
+    path = get_cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logging.warning(f"Couldn't write cache file {path}: {e}")
+
+
+def positive_float(value):
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number")
+    return number
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
 async def clean_up(args):
+    retry = make_retry(args)
     logging.info("Pinging repository...")
-    repository = await get_repository(args)
+    repository = await get_repository(args, retry)
     logging.info(
         f"Found repository:\nrepository = {json.dumps(artifactregistry_v1.Repository.to_dict(repository), indent=4)}"
     )
-    packages = await list_packages(repository)
-    now = datetime.now(UTC)
-    targets = defaultdict(set)
+    packages = await list_packages(repository, retry)
+    threshold = datetime.now(UTC) - timedelta(days=args.retention_days)
+    targets = {}
     pattern = re.compile(args.package)
     unique_expired_versions = set()
-    all_versions = set()
+    total_expired_versions = 0
+    expired_packages = 0
+    # Versions are never created in the past, so a package whose oldest
+    # remaining version is still within the retention period can't have any
+    # expired versions and doesn't need to be listed.
+    cache = {} if args.no_cache else load_cache()
+    oldest_remaining_versions = {}
 
     start = time.time()
 
-    async for package in packages:
-        name = os.path.basename(package.name)
-        if pattern.match(name):
-            logging.info(f"Looking for expired package versions of {name}...")
-            versions = await list_versions(package)
-            async for version in versions:
-                all_versions.add(version.name)
-                if now - version.create_time > timedelta(days=args.retention_days):
-                    targets[package.name].add(version.name)
-                    unique_expired_versions.add(os.path.basename(version.name))
+    async def scan(package, semaphore):
+        cached = cache.get(package.name)
+        if cached is not None and datetime.fromisoformat(cached) >= threshold:
+            logging.info(
+                f"Skipping {os.path.basename(package.name)}, its oldest version was created on {cached}."
+            )
+            return package.name, 0, [], None
+        async with semaphore:
+            logging.info(
+                f"Looking for expired package versions of {os.path.basename(package.name)}..."
+            )
+            versions = await list_versions(package, retry)
+            expired_count = 0
+            expired_names = []
+            oldest_remaining = None
+            # The listing can only stop early if the server really returned the
+            # versions oldest first. Check every version of the pages fetched,
+            # and list all of them if they're out of order.
+            ordered = True
+            previous_create_time = None
+            async for page in versions.pages:
+                expired = []
+                for version in page.versions:
+                    if (
+                        previous_create_time is not None
+                        and version.create_time < previous_create_time
+                    ):
+                        ordered = False
+                    previous_create_time = version.create_time
+                    if version.create_time < threshold:
+                        expired.append(version.name)
+                    elif oldest_remaining is None:
+                        oldest_remaining = version.create_time
+                expired_count += len(expired)
+                unique_expired_versions.update(
+                    version_name.rpartition("/")[2] for version_name in expired
+                )
+                # Nothing gets deleted with --skip-delete, so only the counts
+                # are needed and the version names can be dropped right away.
+                if not args.skip_delete:
+                    expired_names.extend(expired)
+                if ordered and oldest_remaining is not None:
+                    # Every version left to list is more recent than this one.
+                    break
+            if not ordered:
+                logging.warning(
+                    f"Versions of {os.path.basename(package.name)} weren't listed oldest first, checked all of them."
+                )
+                # The first unexpired version seen isn't necessarily the oldest
+                # one, it can't be cached.
+                oldest_remaining = None
+            return package.name, expired_count, expired_names, oldest_remaining
+
+    semaphore = asyncio.Semaphore(LIST_CONCURRENCY)
+    matched = [
+        package
+        async for package in packages
+        if pattern.match(package.name.rpartition("/")[2])
+    ]
+    results = await asyncio.gather(*(scan(package, semaphore) for package in matched))
+
+    for package_name, expired_count, expired_names, oldest_remaining in results:
+        total_expired_versions += expired_count
+        if expired_count:
+            expired_packages += 1
+            # The oldest version of the package only changes once the expired
+            # versions are actually deleted.
+            cache.pop(package_name, None)
+            if oldest_remaining is not None:
+                oldest_remaining_versions[package_name] = oldest_remaining
+        elif oldest_remaining is not None:
+            cache[package_name] = oldest_remaining.isoformat()
+        if expired_names:
+            targets[package_name] = expired_names
+
+    if not args.no_cache:
+        save_cache(cache)
 
     end = time.time()
     elapsed = int(end - start)
@@ -153,24 +347,22 @@ async def clean_up(args):
         f"Done. Looked for {elapsed} seconds (that's about ~{elapsed // 60} minutes.)"
     )
 
-    if not targets:
+    if not expired_packages:
         logging.info("No expired package versions found, nothing to do!")
         exit(0)
 
-    logging.info(f"Found {len(targets)} packages matching {args.package}")
-    total_expired_versions = sum(len(target) for target in targets.values())
-    logging.info(
-        f"Found unique expired versions:\nunique_expired_versions = {json.dumps(list(unique_expired_versions), indent=4)}"
-    )
+    logging.info(f"Found {expired_packages} packages matching {args.package}")
+    # Serializing every unique version is costly, skip it if it won't be logged.
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info(
+            f"Found unique expired versions:\nunique_expired_versions = {json.dumps(list(unique_expired_versions))}"
+        )
     logging.info(
         f"There's a total of {total_expired_versions} expired versions to clean-up!"
     )
     logging.info(
         f"Out of those expired versions, there are {len(unique_expired_versions)} unique versions across all packages."
     )
-    logging.info(
-        f"There's a total of {len(all_versions)} versions. After clean-up, there will be {len(all_versions) - total_expired_versions} versions left."
-    )
 
     if args.skip_delete:
         logging.info(
@@ -181,7 +373,12 @@ async def clean_up(args):
     if args.dry_run:
         logging.info("The dry-run mode is enabled. Doing a no-op run!")
 
-    await batch_delete_versions(targets, args)
+    await batch_delete_versions(targets, args, retry)
+
+    if not args.dry_run and not args.no_cache:
+        for package_name, oldest_remaining in oldest_remaining_versions.items():
+            cache[package_name] = oldest_remaining.isoformat()
+        save_cache(cache)
 
 
 def main():
@@ -232,6 +429,30 @@ def main():
         help='Skip the "delete versions" step (for testing)',
         default=False,
     )
+    clean_up_parser.add_argument(
+        "--delete-concurrency",
+        type=positive_int,
+        help="Maximum number of delete version requests to run concurrently",
+        default=16,
+    )
+    clean_up_parser.add_argument(
+        "--retry-timeout",
+        type=positive_float,
+        help="How long to keep retrying a failed request, in seconds",
+        default=RETRY_TIMEOUT,
+    )
+    clean_up_parser.add_argument(
+        "--retry-max-delay",
+        type=positive_float,
+        help="Maximum delay between two retries of a failed request, in seconds",
+        default=RETRY_MAX_DELAY,
+    )
+    clean_up_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="List the versions of every matching package, ignoring the cache",
+        default=False,
+    )
 
     args = parser.parse_args()
     logging.info(f"Parsed arguments:\nargs = {json.dumps(vars(args), indent=4)}")
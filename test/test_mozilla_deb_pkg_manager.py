@@ -1,7 +1,22 @@
+import argparse
+import asyncio
+import logging
 import sys
 import types
+from datetime import UTC, datetime, timedelta
+
+import pytest
+from google.cloud import artifactregistry_v1
 
 import mozilla_linux_pkg_manager  # noqa
+from mozilla_linux_pkg_manager import cli
+from mozilla_linux_pkg_manager.cli import (
+    batched_seq,
+    load_cache,
+    positive_float,
+    positive_int,
+    save_cache,
+)
 
 
 def test_mozilla_linux_pkg_manager():
@@ -10,3 +25,285 @@ def test_mozilla_linux_pkg_manager():
 
 def test_cli():
     assert isinstance(mozilla_linux_pkg_manager.cli, types.ModuleType)
+
+
+def test_batched_seq():
+    assert list(batched_seq(["a", "b", "c", "d", "e"], 2)) == [
+        ["a", "b"],
+        ["c", "d"],
+        ["e"],
+    ]
+    assert list(batched_seq([], 2)) == []
+    with pytest.raises(ValueError):
+        list(batched_seq(["a"], 0))
+
+
+def test_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    assert load_cache() == {}
+    cache = {"projects/p/packages/firefox": "2023-11-01T00:00:00+00:00"}
+    save_cache(cache)
+    assert load_cache() == cache
+    (tmp_path / "mozilla-linux-pkg-manager" / "state.json").write_text("{")
+    assert load_cache() == {}
+    (tmp_path / "mozilla-linux-pkg-manager" / "state.json").write_text("[]")
+    assert load_cache() == {}
+    save_cache(
+        {
+            **cache,
+            "projects/p/packages/naive": "2023-11-01T00:00:00",
+            "projects/p/packages/garbage": "yesterday",
+            "projects/p/packages/number": 1698796800,
+        }
+    )
+    assert load_cache() == cache
+
+    # An unwritable cache directory doesn't fail the run.
+    blocker = tmp_path / "blocker"
+    blocker.write_text("")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(blocker))
+    save_cache(cache)
+    assert load_cache() == {}
+
+
+def test_positive_int():
+    assert positive_int("16") == 16
+    for value in ("0", "-1"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            positive_int(value)
+
+
+def test_positive_float():
+    assert positive_float("0.5") == 0.5
+    for value in ("0", "-1", "nan"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            positive_float(value)
+
+
+REPOSITORY = "projects/p/locations/us/repositories/r"
+
+
+class FakeOperation:
+    async def result(self):
+        pass
+
+
+class FakePager:
+    def __init__(self, pages, fetched):
+        self._pages = pages
+        self._fetched = fetched
+
+    @property
+    async def pages(self):
+        for page in self._pages:
+            self._fetched.append(page)
+            yield types.SimpleNamespace(versions=page)
+
+
+class FakeClient:
+    """In-memory stand-in for ArtifactRegistryAsyncClient.
+
+    `packages` maps package names to pages of versions, each version being
+    created the given number of days ago.
+    """
+
+    def __init__(self, packages):
+        now = datetime.now(UTC)
+        self.packages = {
+            f"{REPOSITORY}/packages/{package}": [
+                [
+                    types.SimpleNamespace(
+                        name=f"{REPOSITORY}/packages/{package}/versions/{days}d",
+                        create_time=now - timedelta(days=days),
+                    )
+                    for days in page
+                ]
+                for page in pages
+            ]
+            for package, pages in packages.items()
+        }
+        self.fetched = []
+        self.listed = []
+        self.batches = []
+        self.deleted = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get_repository(self, request, retry):
+        return artifactregistry_v1.Repository(name=request.name)
+
+    async def list_packages(self, request, retry):
+        async def packages():
+            for name in self.packages:
+                yield types.SimpleNamespace(name=name)
+
+        return packages()
+
+    async def list_versions(self, request, retry):
+        self.listed.append(request.parent)
+        return FakePager(self.packages[request.parent], self.fetched)
+
+    async def batch_delete_versions(self, request, retry):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        # Let the other deletes run before this one finishes.
+        await asyncio.sleep(0)
+        self.in_flight -= 1
+        self.batches.append(
+            (request.parent, list(request.names), request.validate_only)
+        )
+        if not request.validate_only:
+            self.deleted.extend(request.names)
+        return FakeOperation()
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    def make(packages):
+        client = FakeClient(packages)
+        monkeypatch.setattr(cli, "get_client", lambda: client)
+        return client
+
+    monkeypatch.setenv("GOOGLE_CLOUD_PROJECT", "p")
+    return make
+
+
+def clean_up_args(**kwargs):
+    args = {
+        "package": "^firefox",
+        "repository": "r",
+        "region": "us",
+        "retention_days": 30,
+        "dry_run": False,
+        "skip_delete": False,
+        "delete_concurrency": 16,
+        "retry_timeout": cli.RETRY_TIMEOUT,
+        "retry_max_delay": cli.RETRY_MAX_DELAY,
+        "no_cache": True,
+    }
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def deleted_versions(client):
+    return sorted(name.rpartition("/")[2] for name in client.deleted)
+
+
+def test_clean_up_stops_at_first_unexpired_version(fake_client):
+    client = fake_client({"firefox": [[100, 60], [40, 10], [5, 1]]})
+    asyncio.run(cli.clean_up(clean_up_args()))
+    assert deleted_versions(client) == ["100d", "40d", "60d"]
+    # The last page only holds unexpired versions, it isn't fetched.
+    assert len(client.fetched) == 2
+
+
+def test_clean_up_deletes_in_batches(fake_client):
+    client = fake_client({"firefox": [list(range(150, 30, -1))]})
+    asyncio.run(cli.clean_up(clean_up_args(delete_concurrency=2)))
+    assert sorted(len(names) for _, names, _ in client.batches) == [20, 50, 50]
+    assert len(client.deleted) == len(set(client.deleted)) == 120
+    assert client.max_in_flight == 2
+
+
+def test_clean_up_skip_delete(fake_client, caplog):
+    caplog.set_level(logging.INFO)
+    client = fake_client(
+        {"firefox": [[100, 60, 1]], "firefox-beta": [[60, 40]], "firefox-esr": [[1]]}
+    )
+    with pytest.raises(SystemExit) as excinfo:
+        asyncio.run(cli.clean_up(clean_up_args(skip_delete=True)))
+    assert excinfo.value.code == 0
+    assert client.batches == []
+    assert client.deleted == []
+    messages = [record.getMessage() for record in caplog.records]
+    assert "Found 2 packages matching ^firefox" in messages
+    assert "There's a total of 4 expired versions to clean-up!" in messages
+    assert (
+        "Out of those expired versions, there are 3 unique versions across all packages."
+        in messages
+    )
+    assert messages[-1] == (
+        'The skip-delete flag is enabled. Skipping the "delete versions" step!'
+    )
+
+
+def test_clean_up_lists_everything_when_unordered(fake_client):
+    client = fake_client({"firefox": [[1, 100]], "firefox-beta": [[1, 60], [40]]})
+    asyncio.run(cli.clean_up(clean_up_args()))
+    assert deleted_versions(client) == ["100d", "40d", "60d"]
+    assert len(client.fetched) == 3
+
+
+def test_clean_up_cache(fake_client, monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    firefox = f"{REPOSITORY}/packages/firefox"
+    beta = f"{REPOSITORY}/packages/firefox-beta"
+    args = clean_up_args(no_cache=False)
+
+    # Nothing is expired, the oldest version of each package gets cached.
+    client = fake_client({"firefox": [[10, 1]], "firefox-beta": [[20]]})
+    with pytest.raises(SystemExit):
+        asyncio.run(cli.clean_up(args))
+    cache = load_cache()
+    assert sorted(cache) == [firefox, beta]
+    oldest = client.packages[firefox][0][0].create_time
+    assert datetime.fromisoformat(cache[firefox]) == oldest
+
+    # Packages whose oldest version isn't expired yet aren't listed again.
+    client = fake_client({"firefox": [[10, 1]], "firefox-beta": [[20]]})
+    with pytest.raises(SystemExit):
+        asyncio.run(cli.clean_up(args))
+    assert client.listed == []
+
+    # A dry run leaves the expired versions in place, so nothing is cached
+    # for packages that have some.
+    client = fake_client({"firefox": [[100, 1]], "firefox-beta": [[20]]})
+    asyncio.run(
+        cli.clean_up(clean_up_args(no_cache=False, retention_days=5, dry_run=True))
+    )
+    assert client.deleted == []
+    assert len(client.batches) == 2
+    assert all(validate_only for _, _, validate_only in client.batches)
+    assert load_cache() == {}
+
+    # Once they are deleted, the oldest remaining version is cached.
+    client = fake_client({"firefox": [[100, 1]], "firefox-beta": [[20]]})
+    asyncio.run(cli.clean_up(clean_up_args(no_cache=False, retention_days=5)))
+    assert deleted_versions(client) == ["100d", "20d"]
+    assert not any(validate_only for _, _, validate_only in client.batches)
+    cache = load_cache()
+    assert sorted(cache) == [firefox]
+    oldest = client.packages[firefox][0][1].create_time
+    assert datetime.fromisoformat(cache[firefox]) == oldest
+
+
+def test_clean_up_doesnt_cache_unordered_versions(fake_client, monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    client = fake_client({"firefox": [[1, 100, 5]], "firefox-beta": [[1, 5]]})
+    asyncio.run(cli.clean_up(clean_up_args(no_cache=False)))
+    assert deleted_versions(client) == ["100d"]
+    assert load_cache() == {}
+
+
+def test_get_client(monkeypatch, mocker):
+    calls = []
+
+    def create_channel(host, **kwargs):
+        calls.append((host, kwargs))
+        return mocker.MagicMock()
+
+    monkeypatch.setattr(cli, "_CLIENT", None)
+    monkeypatch.setattr(
+        cli.ArtifactRegistryGrpcAsyncIOTransport,
+        "create_channel",
+        staticmethod(create_channel),
+    )
+    client = cli.get_client()
+    assert isinstance(client, artifactregistry_v1.ArtifactRegistryAsyncClient)
+    assert cli.get_client() is client
+    assert calls == [
+        (
+            "artifactregistry.googleapis.com:443",
+            {"options": cli.GRPC_CHANNEL_OPTIONS},
+        )
+    ]